@@ -20,3 +20,7 @@ pip install --upgrade pip
 pip install wheel
 pip install PyMuPDF==1.22.5 --no-build-isolation
 pip install -r requirements.txt
+
+# Compile the pipeline's hot-loop helpers (falls back to pure Python on failure)
+pip install mypy
+mypyc pipeline/_hot.py || echo "mypyc build failed - using pure-Python pipeline/_hot.py"
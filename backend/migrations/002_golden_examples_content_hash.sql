@@ -0,0 +1,10 @@
+-- Migration: 002_golden_examples_content_hash
+-- Adds a content hash of the uploaded file to golden_examples so the blueprint
+-- pipeline can reuse an existing blueprint when identical bytes are re-uploaded.
+-- Run this in the Supabase SQL editor.
+
+ALTER TABLE golden_examples ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+CREATE INDEX IF NOT EXISTS golden_examples_content_hash_idx
+    ON golden_examples (content_hash)
+    WHERE content_hash IS NOT NULL;
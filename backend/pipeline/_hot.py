@@ -0,0 +1,49 @@
+"""
+Hot-loop helpers for the Document DNA pipeline.
+
+These run once per text span in the preprocessor's PDF extraction loop, so they
+are kept small, fully typed, and free of dynamic features that mypyc cannot
+compile. The Docker build compiles this module with mypyc; when the compiled
+extension is absent the pure-Python module is imported instead, with identical behavior.
+"""
+
+import sys
+from typing import Optional
+
+
+# color int → "#RRGGBB" memo; bounded so adversarial PDFs cannot grow it without limit.
+# Values are interned so every block sharing a colour (PDF or DOCX) shares one string.
+_BLACK = sys.intern("#000000")
+_HEX_CACHE: dict[int, str] = {0: _BLACK}
+_HEX_CACHE_MAX = 4096
+
+
+def color_int_to_hex(color_int: Optional[int]) -> str:
+    """
+    Convert PyMuPDF integer color to hex string.
+    Documents use a handful of colors, so results are memoized per color int.
+    """
+    if color_int is None:
+        return _BLACK
+    color_hex = _HEX_CACHE.get(color_int)
+    if color_hex is not None:
+        return color_hex
+    color_hex = sys.intern("#" + (color_int & 0xFFFFFF).to_bytes(3, "big").hex().upper())
+    if len(_HEX_CACHE) < _HEX_CACHE_MAX:
+        _HEX_CACHE[color_int] = color_hex
+    return color_hex
+
+
+def extract_span_style(font: str, flags: int, size: float, color: Optional[int]) -> dict:
+    """Build the IDM style dict for a PyMuPDF text span."""
+    return {
+        # Subset fonts are named "ABCDEF+RealName"; rpartition is one C call either way.
+        # Interned: a document repeats a handful of font names across thousands of blocks.
+        "font_name": sys.intern(font.rpartition("+")[2]),
+        "font_size_pt": round(size, 1),
+        "font_weight": "bold" if ("Bold" in font or flags & 16) else "normal",
+        "font_italic": bool(flags & 2),
+        "color_hex": color_int_to_hex(color),
+        "background_color_hex": None,
+        "text_alignment": "left",
+    }
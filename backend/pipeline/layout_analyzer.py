@@ -8,10 +8,17 @@ For PDFs (with bounding boxes): fully algorithmic.
 For DOCX (no bboxes): falls back to a Claude call that infers layout from section structure.
 """
 
+import heapq
 import json
 from collections import Counter, defaultdict
 from typing import Optional
 
+import numpy as np
+import orjson
+
+from pipeline.models import BLOCK_TYPE_CODES
+from pipeline.preprocessor import build_blocks_array
+
 
 CLAUDE_MODEL = "claude-sonnet-4-6"
 MAX_TOKENS = 2000
@@ -27,11 +34,45 @@ _COLUMN_MIN_FRACTION = 0.15
 # Bin width for x0 clustering
 _BIN_WIDTH_PT = 20.0
 
+# DOCX fallback: number of leading blocks sent to Claude as a structure sample
+_FALLBACK_SAMPLE_BLOCKS = 30
+
 
 def _bucket(value: float, width: float) -> int:
     return int(value / width)
 
 
+def _max_bucket_count(buckets: np.ndarray) -> int:
+    """Return the size of the most populated bucket (0 if there are none)."""
+    if not buckets.size:
+        return 0
+    # Shift so bincount also accepts (rare) negative buckets from slightly off-page blocks
+    return int(np.bincount(buckets - buckets.min()).max())
+
+
+def _collect_block_arrays(idm: dict) -> dict:
+    """
+    Return per-field NumPy views (structure-of-arrays) over the IDM's bbox-bearing blocks
+    so the detectors can run vectorized instead of re-walking the list-of-dicts IDM.
+    Uses the preprocessor's idm["blocks_array"] when present.
+    """
+    blocks = idm.get("blocks_array")
+    if blocks is None:
+        blocks = build_blocks_array(idm.get("pages", []))
+
+    return {
+        "x0": blocks["x0"],
+        "y0": blocks["y0"],
+        "x1": blocks["x1"],
+        "y1": blocks["y1"],
+        "page_idx": blocks["page"],
+        "is_text": blocks["block_type"] == BLOCK_TYPE_CODES["text"],
+        "is_table": blocks["block_type"] == BLOCK_TYPE_CODES["table"],
+        "font_size": blocks["font_size"],
+        "is_bold": blocks["is_bold"] == 1,
+    }
+
+
 def _detect_column_structure(pages: list) -> str:
     """Return 'single' or 'two-column' based on x0 distribution of text blocks."""
     x0_buckets: Counter = Counter()
@@ -66,31 +107,24 @@ def _detect_column_structure(pages: list) -> str:
     return "single"
 
 
-def _detect_margins(pages: list, width_pt: Optional[float], height_pt: Optional[float]) -> dict:
+def _detect_margins(arrs: dict, width_pt: Optional[float], height_pt: Optional[float]) -> dict:
     """Estimate margins by averaging the extremal positions of text blocks across pages."""
-    left_margins = []
-    right_margins = []
-    top_margins = []
-    bottom_margins = []
-
-    for page in pages:
-        text_blocks = [b for b in page.get("blocks", []) if b.get("block_type") == "text" and b.get("bbox")]
-        if not text_blocks:
-            continue
-
-        left_margins.append(min(b["bbox"]["x0"] for b in text_blocks))
-        right_margins.append(max(b["bbox"]["x1"] for b in text_blocks))
-        top_margins.append(min(b["bbox"]["y0"] for b in text_blocks))
-        bottom_margins.append(max(b["bbox"]["y1"] for b in text_blocks))
-
-    def _avg(lst):
-        return round(sum(lst) / len(lst)) if lst else 72
-
-    left = _avg(left_margins)
-    top = _avg(top_margins)
-
-    right = round(width_pt - _avg(right_margins)) if width_pt else 72
-    bottom = round(height_pt - _avg(bottom_margins)) if height_pt else 72
+    is_text = arrs["is_text"]
+    page_idx = arrs["page_idx"][is_text]
+
+    if page_idx.size:
+        # Blocks are collected in page order, so each page is a contiguous run and
+        # one reduceat per edge yields every page's extremum at once.
+        page_starts = np.flatnonzero(np.r_[True, page_idx[1:] != page_idx[:-1]])
+        left = round(float(np.minimum.reduceat(arrs["x0"][is_text], page_starts).mean()))
+        top = round(float(np.minimum.reduceat(arrs["y0"][is_text], page_starts).mean()))
+        avg_right = round(float(np.maximum.reduceat(arrs["x1"][is_text], page_starts).mean()))
+        avg_bottom = round(float(np.maximum.reduceat(arrs["y1"][is_text], page_starts).mean()))
+    else:
+        left = top = avg_right = avg_bottom = 72
+
+    right = round(width_pt - avg_right) if width_pt else 72
+    bottom = round(height_pt - avg_bottom) if height_pt else 72
 
     # Clamp to reasonable values (18pt–144pt)
     def _clamp(v):
@@ -104,78 +138,104 @@ def _detect_margins(pages: list, width_pt: Optional[float], height_pt: Optional[
     }
 
 
-def _detect_header_footer(pages: list, height_pt: Optional[float]) -> tuple:
+def _detect_header_footer(arrs: dict, page_count: int, height_pt: Optional[float]) -> tuple:
     """
     Detect persistent header and footer blocks.
     Returns (header_present, header_pattern, footer_present, footer_pattern).
     """
-    if not pages or not height_pt:
+    if not page_count or not height_pt:
         return False, "", False, ""
 
-    page_count = len(pages)
     threshold = max(2, int(page_count * _HEADER_FOOTER_PAGE_FRACTION))
 
-    # Track y0 ranges of blocks appearing near top / bottom across pages
-    top_y_counts: Counter = Counter()
-    bottom_y_counts: Counter = Counter()
+    is_text = arrs["is_text"]
+    y0 = arrs["y0"][is_text]
+    y1 = arrs["y1"][is_text]
 
-    for page in pages:
-        for block in page.get("blocks", []):
-            bbox = block.get("bbox")
-            if not bbox or block.get("block_type") != "text":
-                continue
-            y0_bucket = _bucket(bbox["y0"], _HEADER_FOOTER_Y_TOLERANCE_PT)
-            y1_bucket = _bucket(bbox["y1"], _HEADER_FOOTER_Y_TOLERANCE_PT)
-            # Top 8% of page
-            if bbox["y0"] < height_pt * 0.08:
-                top_y_counts[y0_bucket] += 1
-            # Bottom 8% of page
-            if bbox["y1"] > height_pt * 0.92:
-                bottom_y_counts[y1_bucket] += 1
-
-    header_present = any(count >= threshold for count in top_y_counts.values())
-    footer_present = any(count >= threshold for count in bottom_y_counts.values())
+    # Histogram the y-buckets of text blocks in the top / bottom 8% of the page
+    top_buckets = (y0[y0 < height_pt * 0.08] / _HEADER_FOOTER_Y_TOLERANCE_PT).astype(np.int32)
+    bottom_buckets = (y1[y1 > height_pt * 0.92] / _HEADER_FOOTER_Y_TOLERANCE_PT).astype(np.int32)
+
+    header_present = _max_bucket_count(top_buckets) >= threshold
+    footer_present = _max_bucket_count(bottom_buckets) >= threshold
 
     return header_present, "repeating" if header_present else "", footer_present, "page_number" if footer_present else ""
 
 
-def _detect_spacing(pages: list) -> dict:
+class OnlineMedian:
+    """
+    Running median over a stream of samples using two heaps, so spacing medians can be
+    updated page by page without re-sorting: O(log N) per add, O(1) per query.
+
+    value() returns the upper median (sorted(samples)[len // 2]), matching the batch
+    median Stage C has always reported.
+    """
+
+    def __init__(self):
+        self._lo: list = []   # max-heap of the lower half (values negated)
+        self._hi: list = []   # min-heap of the upper half; holds the extra sample when odd
+
+    def __len__(self) -> int:
+        return len(self._lo) + len(self._hi)
+
+    def add(self, value: float) -> None:
+        if self._hi and value < self._hi[0]:
+            heapq.heappush(self._lo, -value)
+        else:
+            heapq.heappush(self._hi, value)
+        self._rebalance()
+
+    def extend(self, values: list) -> None:
+        """Bulk insert: split around the current median, heapify once, then rebalance."""
+        if not values:
+            return
+        if self._hi:
+            pivot = self._hi[0]
+            self._lo.extend(-v for v in values if v < pivot)
+            self._hi.extend(v for v in values if v >= pivot)
+        else:
+            self._hi.extend(values)
+        heapq.heapify(self._lo)
+        heapq.heapify(self._hi)
+        self._rebalance()
+
+    def value(self) -> Optional[float]:
+        return self._hi[0] if self._hi else None
+
+    def _rebalance(self) -> None:
+        while len(self._hi) > len(self._lo) + 1:
+            heapq.heappush(self._lo, -heapq.heappop(self._hi))
+        while len(self._lo) > len(self._hi):
+            heapq.heappush(self._hi, -heapq.heappop(self._lo))
+
+
+def _detect_spacing(arrs: dict) -> dict:
     """
     Estimate spacing rules by measuring y-gaps between consecutive text blocks.
     Returns a dict of spacing_rules values.
     """
-    heading_gaps_before = []
-    heading_gaps_after = []
-    para_gaps = []
-
-    for page in pages:
-        blocks = [b for b in page.get("blocks", []) if b.get("block_type") == "text" and b.get("bbox")]
-        for i in range(1, len(blocks)):
-            prev = blocks[i - 1]
-            curr = blocks[i]
-            gap = round(curr["bbox"]["y0"] - prev["bbox"]["y1"], 1)
-            if gap <= 0:
-                continue
-
-            prev_style = prev.get("style") or {}
-            curr_style = curr.get("style") or {}
-
-            prev_is_heading = (prev_style.get("font_size_pt") or 0) >= 13 or prev_style.get("font_weight") == "bold"
-            curr_is_heading = (curr_style.get("font_size_pt") or 0) >= 13 or curr_style.get("font_weight") == "bold"
-
-            if curr_is_heading:
-                heading_gaps_before.append(gap)
-            elif prev_is_heading:
-                heading_gaps_after.append(gap)
-            else:
-                para_gaps.append(gap)
-
-    def _median(lst, default):
-        if not lst:
-            return default
-        s = sorted(lst)
-        mid = len(s) // 2
-        return round(s[mid], 1)
+    is_text = arrs["is_text"]
+    y0 = arrs["y0"][is_text]
+    y1 = arrs["y1"][is_text]
+    page_idx = arrs["page_idx"][is_text]
+    is_heading = (arrs["font_size"][is_text] >= 13.0) | arrs["is_bold"][is_text]
+
+    # Gap between each block and its predecessor on the same page
+    gaps = np.round(y0[1:] - y1[:-1], 1)
+    valid = (page_idx[1:] == page_idx[:-1]) & (gaps > 0)
+    curr_is_heading = is_heading[1:]
+    prev_is_heading = is_heading[:-1]
+
+    heading_gaps_before = OnlineMedian()
+    heading_gaps_after = OnlineMedian()
+    para_gaps = OnlineMedian()
+    heading_gaps_before.extend(gaps[valid & curr_is_heading].tolist())
+    heading_gaps_after.extend(gaps[valid & ~curr_is_heading & prev_is_heading].tolist())
+    para_gaps.extend(gaps[valid & ~curr_is_heading & ~prev_is_heading].tolist())
+
+    def _median(median, default):
+        value = median.value()
+        return default if value is None else round(value, 1)
 
     return {
         "before_h1_pt": _median(heading_gaps_before, 24.0),
@@ -187,18 +247,14 @@ def _detect_spacing(pages: list) -> dict:
     }
 
 
-def _detect_table_placement(pages: list, width_pt: Optional[float]) -> str:
+def _detect_table_placement(arrs: dict, width_pt: Optional[float]) -> str:
     """Estimate whether tables are full-width or inline."""
-    if not width_pt:
+    is_table = arrs["is_table"]
+    if not width_pt or not is_table.any():
         return "inline"
     text_column_width = width_pt * 0.7  # rough estimate
-    for page in pages:
-        for block in page.get("blocks", []):
-            if block.get("block_type") == "table" and block.get("bbox"):
-                block_width = block["bbox"]["x1"] - block["bbox"]["x0"]
-                if block_width >= text_column_width:
-                    return "full_width"
-    return "inline"
+    widths = arrs["x1"][is_table] - arrs["x0"][is_table]
+    return "full_width" if (widths >= text_column_width).any() else "inline"
 
 
 async def _claude_layout_fallback(idm: dict, client) -> dict:
@@ -206,16 +262,22 @@ async def _claude_layout_fallback(idm: dict, client) -> dict:
     For DOCX (no bboxes), ask Claude to infer layout values from the section structure.
     Returns a partial layout_spec dict.
     """
+    # Only the first _FALLBACK_SAMPLE_BLOCKS blocks are sent, so stop walking the IDM
+    # as soon as they are collected.
     sections_summary = []
     for page in idm.get("pages", []):
         for block in page.get("blocks", []):
-            text = block.get("text", "")[:80]
             style = block.get("style") or {}
             sections_summary.append({
-                "text_preview": text,
+                "text_preview": block.get("text", "")[:80],
                 "font_size_pt": style.get("font_size_pt"),
                 "font_weight": style.get("font_weight"),
             })
+            if len(sections_summary) >= _FALLBACK_SAMPLE_BLOCKS:
+                break
+        if len(sections_summary) >= _FALLBACK_SAMPLE_BLOCKS:
+            break
+    blocks_json = orjson.dumps(sections_summary, option=orjson.OPT_INDENT_2).decode()
 
     prompt = (
         "Based on this document's block structure (from a DOCX file with no coordinate data), "
@@ -225,7 +287,7 @@ async def _claude_layout_fallback(idm: dict, client) -> dict:
         '"paragraph_spacing_pt": N, "line_spacing_multiple": N}, '
         '"header_rule": {"present": bool, "content_pattern": ""}, '
         '"footer_rule": {"present": bool, "content_pattern": ""}}\n\n'
-        f"Document blocks (first 30):\n{json.dumps(sections_summary[:30], indent=2)}"
+        f"Document blocks (first {_FALLBACK_SAMPLE_BLOCKS}):\n{blocks_json}"
     )
 
     response = await client.messages.create(
@@ -271,11 +333,12 @@ async def analyze_layout(idm: dict, client) -> dict:
 
         if has_bboxes and pages:
             page_size = metadata.get("page_size", "A4")
-            margins = _detect_margins(pages, width_pt, height_pt)
+            arrs = _collect_block_arrays(idm)
+            margins = _detect_margins(arrs, width_pt, height_pt)
             column_structure = _detect_column_structure(pages)
-            header_present, header_pattern, footer_present, footer_pattern = _detect_header_footer(pages, height_pt)
-            spacing_rules = _detect_spacing(pages)
-            table_placement = _detect_table_placement(pages, width_pt)
+            header_present, header_pattern, footer_present, footer_pattern = _detect_header_footer(arrs, len(pages), height_pt)
+            spacing_rules = _detect_spacing(arrs)
+            table_placement = _detect_table_placement(arrs, width_pt)
 
             return {
                 "page_size": page_size,
@@ -5,7 +5,7 @@ Defines the Intermediate Document Model (IDM) and the JSON Blueprint schema.
 
 from typing import Optional, List, Any
 from pydantic import BaseModel, Field
-import datetime
+import numpy as np
 
 
 # ---------------------------------------------------------------------------
@@ -13,6 +13,8 @@ import datetime
 # ---------------------------------------------------------------------------
 
 class BlockStyle(BaseModel):
+    # Stage A emits font_name and color_hex canonical and interned: color_hex is always
+    # upper-case "#RRGGBB", so consumers can compare and hash them without re-normalising.
     font_name: Optional[str] = None
     font_size_pt: Optional[float] = None
     font_weight: Optional[str] = None        # "normal" | "bold"
@@ -39,7 +41,8 @@ class Block(BaseModel):
     block_type: str                          # "text" | "image" | "table" | "header" | "footer"
     bbox: Optional[BBox] = None              # None for DOCX (no native coordinate system)
     text: str = ""
-    lines: List[Line] = Field(default_factory=list)
+    lines: List[Line] = Field(default_factory=list)   # only populated by build_idm(include_lines=True)
+    line_count: int = 0
     style: Optional[BlockStyle] = None
     ocr_confidence: Optional[float] = None  # None if native; 0.0-1.0 if OCR
 
@@ -59,6 +62,24 @@ class DocumentMetadata(BaseModel):
     ocr_used: bool = False
 
 
+# Structure-of-arrays view of every bbox-bearing IDM block, stored alongside the
+# dict pages as idm["blocks_array"] so numeric consumers (Stage C) skip dict lookups.
+# Coordinates stay float64 so results match the dict path exactly.
+IDM_BLOCK_DTYPE = np.dtype([
+    ("x0", "f8"),
+    ("y0", "f8"),
+    ("x1", "f8"),
+    ("y1", "f8"),
+    ("page", "i4"),          # 0-based page index
+    ("block_type", "u1"),    # BLOCK_TYPE_CODES value
+    ("font_size", "f4"),     # 0.0 when unknown
+    ("is_bold", "u1"),
+])
+
+BLOCK_TYPE_CODES = {"text": 0, "image": 1, "table": 2, "header": 3, "footer": 4}
+BLOCK_TYPE_UNKNOWN = 255
+
+
 class IntermediateDocumentModel(BaseModel):
     document_id: str
     source_format: str                       # "pdf" | "docx" | "image"
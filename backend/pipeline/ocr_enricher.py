@@ -177,6 +177,7 @@ async def enrich_idm_with_vision_ocr(idm: dict, file_bytes: bytes, client) -> di
                     "bbox": None,
                     "text": ocr_text,
                     "lines": [{"text": ocr_text, "bbox": None}],
+                    "line_count": 1,
                     "style": None,
                     "ocr_confidence": None,
                 })
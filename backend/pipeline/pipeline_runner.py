@@ -7,12 +7,17 @@ Wires all five stages together and manages async execution:
   Stage E (Assembler)    → synchronous
 
 Also exposes run_pipeline_and_store() which updates the golden_examples DB record
-with the final blueprint and processing status.
+with the final blueprint and processing status. Re-uploads of byte-identical files
+reuse the stored blueprint (matched on content_hash) instead of re-running the pipeline.
 """
 
 import asyncio
 import datetime
+import hashlib
+import uuid
 import anthropic
+import httpx
+import orjson
 from supabase import create_client
 
 from pipeline.preprocessor import build_idm
@@ -23,6 +28,119 @@ from pipeline.visual_style_analyzer import analyze_visual_style
 from pipeline.blueprint_assembler import assemble_blueprint
 
 
+_DB_WRITE_TIMEOUT = 30  # seconds
+
+# api_key → (event loop, AsyncAnthropic): one client and HTTP connection pool reused across runs.
+# The client's pool is bound to the loop it first ran on, so a new loop gets a new client.
+_clients: dict = {}
+
+
+def _get_client(api_key: str) -> anthropic.AsyncAnthropic:
+    loop = asyncio.get_running_loop()
+    cached = _clients.get(api_key)
+    if cached is None or cached[0] is not loop:
+        cached = _clients[api_key] = (loop, anthropic.AsyncAnthropic(api_key=api_key))
+    return cached[1]
+
+
+def _now_iso() -> str:
+    """Current UTC time as a timezone-aware ISO-8601 string for DB timestamps."""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+async def _store_blueprint(
+    supabase_url: str,
+    supabase_key: str,
+    golden_example_id: str,
+    blueprint: dict,
+    content_hash: str,
+) -> None:
+    """
+    Write the finished blueprint to the golden_examples record.
+
+    The blueprint is the largest payload in the pipeline, so it is encoded once with
+    orjson and PATCHed straight to the Supabase REST endpoint instead of going through
+    the sync supabase-py client, which would re-serialize the dict on the event loop.
+
+    content_hash needs migration 002. On a project without that column PostgREST
+    rejects the PATCH with a 400 naming it, so the row is re-sent without the hash:
+    the blueprint is still stored, only the re-upload cache stays empty.
+    """
+    fields = {
+        "blueprint": blueprint,
+        "status": "ready",
+        "processing_error": None,
+        "processing_completed_at": _now_iso(),
+        "content_hash": content_hash,
+    }
+
+    async with httpx.AsyncClient(timeout=_DB_WRITE_TIMEOUT) as http:
+        resp = await _patch_golden_example(http, supabase_url, supabase_key, golden_example_id, fields)
+        if resp.status_code == 400 and "content_hash" in resp.text:
+            print(
+                f"[{golden_example_id}] golden_examples.content_hash missing "
+                f"(migration 002 not applied) — storing blueprint without it"
+            )
+            del fields["content_hash"]
+            resp = await _patch_golden_example(http, supabase_url, supabase_key, golden_example_id, fields)
+        resp.raise_for_status()
+
+
+async def _patch_golden_example(
+    http: httpx.AsyncClient,
+    supabase_url: str,
+    supabase_key: str,
+    golden_example_id: str,
+    fields: dict,
+) -> httpx.Response:
+    return await http.patch(
+        f"{supabase_url.rstrip('/')}/rest/v1/golden_examples",
+        params={"id": f"eq.{golden_example_id}"},
+        content=orjson.dumps(fields, option=orjson.OPT_NON_STR_KEYS),
+        headers={
+            "apikey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}",
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal",
+        },
+    )
+
+
+def _find_cached_blueprint(
+    supabase,
+    content_hash: str,
+    document_type: str,
+    golden_example_id: str,
+) -> dict | None:
+    """
+    Return a copy of a ready blueprint previously built from identical file bytes
+    for the same document type, re-keyed to golden_example_id. Returns None on a
+    miss or if the lookup fails (the pipeline then runs as normal).
+    """
+    try:
+        response = (
+            supabase.table("golden_examples")
+            .select("blueprint")
+            .eq("content_hash", content_hash)
+            .eq("document_type", document_type)
+            .eq("status", "ready")
+            .neq("id", golden_example_id)
+            .limit(1)
+            .execute()
+        )
+    except Exception as e:
+        print(f"[{golden_example_id}] Blueprint cache lookup failed: {e}")
+        return None
+
+    if not response.data or not response.data[0].get("blueprint"):
+        return None
+
+    blueprint = dict(response.data[0]["blueprint"])
+    blueprint["blueprint_id"] = str(uuid.uuid4())
+    blueprint["golden_example_id"] = golden_example_id
+    blueprint["generated_at"] = _now_iso().replace("+00:00", "Z")
+    return blueprint
+
 
 async def run_pipeline(
     file_bytes: bytes,
@@ -47,11 +165,12 @@ async def run_pipeline(
     Returns:
         Assembled blueprint dict.
     """
-    client = anthropic.AsyncAnthropic(api_key=anthropic_api_key)
+    client = _get_client(anthropic_api_key)
 
-    # Stage A — Preprocessing (synchronous, fast)
+    # Stage A — Preprocessing (CPU-bound; runs in a worker thread)
     print(f"[{golden_example_id}] Stage A: preprocessing {filename}")
-    idm = build_idm(file_bytes, filename)
+    # Off the event loop: long PDFs wait on the extraction pool, and other uploads keep running
+    idm = await asyncio.to_thread(build_idm, file_bytes, filename)
     source_format = idm.get("source_format", "pdf")
     print(
         f"[{golden_example_id}] IDM built: {idm['page_count']} pages, "
@@ -132,7 +251,7 @@ async def run_pipeline_and_store(
 
     Updates:
       - status → 'processing' at start
-      - status → 'ready' + blueprint on success
+      - status → 'ready' + blueprint + content_hash on success
       - status → 'error' + processing_error on failure
     """
     supabase = create_client(supabase_url, supabase_key)
@@ -140,24 +259,25 @@ async def run_pipeline_and_store(
     # Mark as processing
     supabase.table("golden_examples").update({
         "status": "processing",
-        "processing_started_at": datetime.datetime.utcnow().isoformat(),
+        "processing_started_at": _now_iso(),
     }).eq("id", golden_example_id).execute()
 
     try:
-        blueprint = await run_pipeline(
-            file_bytes=file_bytes,
-            filename=filename,
-            document_type=document_type,
-            golden_example_id=golden_example_id,
-            anthropic_api_key=anthropic_api_key,
-        )
+        content_hash = hashlib.blake2b(file_bytes, digest_size=32).hexdigest()
+        blueprint = _find_cached_blueprint(supabase, content_hash, document_type, golden_example_id)
+
+        if blueprint is not None:
+            print(f"[{golden_example_id}] Identical upload found, reusing stored blueprint")
+        else:
+            blueprint = await run_pipeline(
+                file_bytes=file_bytes,
+                filename=filename,
+                document_type=document_type,
+                golden_example_id=golden_example_id,
+                anthropic_api_key=anthropic_api_key,
+            )
 
-        supabase.table("golden_examples").update({
-            "blueprint": blueprint,
-            "status": "ready",
-            "processing_error": None,
-            "processing_completed_at": datetime.datetime.utcnow().isoformat(),
-        }).eq("id", golden_example_id).execute()
+        await _store_blueprint(supabase_url, supabase_key, golden_example_id, blueprint, content_hash)
 
         print(f"Blueprint stored for golden_example_id={golden_example_id}")
 
@@ -168,7 +288,7 @@ async def run_pipeline_and_store(
             supabase.table("golden_examples").update({
                 "status": "error",
                 "processing_error": error_msg[:1000],
-                "processing_completed_at": datetime.datetime.utcnow().isoformat(),
+                "processing_completed_at": _now_iso(),
             }).eq("id", golden_example_id).execute()
         except Exception as db_err:
             print(f"Failed to update error status: {db_err}")
@@ -8,9 +8,17 @@ Uses Claude with tool-use (function calling) to enforce structured JSON output.
 """
 
 import base64
+import copy
+import hashlib
+import io
+import itertools
 import json
+from collections import OrderedDict
+from types import MappingProxyType
 from typing import Any
 
+import orjson
+
 
 CLAUDE_MODEL = "claude-sonnet-4-6"
 MAX_TOKENS = 12000
@@ -242,6 +250,25 @@ For each section:
 
 Always call the tool — never return plain text."""
 
+# Everything in the messages.create request except messages= is fixed at import time;
+# read-only so no call site can mutate the shared scaffold.
+_BASE_KWARGS = MappingProxyType({
+    "model": CLAUDE_MODEL,
+    "max_tokens": MAX_TOKENS,
+    "system": _SYSTEM_PROMPT,
+    "tools": [_STRUCTURE_TOOL],
+    "tool_choice": {"type": "tool", "name": "document_structure"},
+})
+
+# Bounded LRU of Claude results keyed on a hash of the call inputs (see _spec_cache_key).
+# _TOOL_VERSION changes whenever the tool schema or system prompt is edited.
+_SPEC_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+_SPEC_CACHE_MAX = 1024
+_TOOL_VERSION = hashlib.blake2b(
+    (json.dumps(_STRUCTURE_TOOL, sort_keys=True) + _SYSTEM_PROMPT).encode("utf-8"),
+    digest_size=8,
+).hexdigest()
+
 
 def _is_heading(block: dict) -> bool:
     """Heuristic: is this block a heading?"""
@@ -262,7 +289,7 @@ def _render_pdf_pages_for_vision(file_bytes: bytes, n_pages: int = _VISION_PAGES
     """
     Render the first n_pages of a PDF to base64-encoded PNGs using PyMuPDF.
     Returns a list of base64 strings (one per page).
-    Mirrors visual_style_analyzer._render_pages_to_base64().
+    Mirrors visual_style_analyzer._render_page_to_base64().
     """
     import fitz
     doc = fitz.open(stream=file_bytes, filetype="pdf")
@@ -289,64 +316,122 @@ def _condense_idm_to_text(idm: dict) -> str:
     - '[{size_pt}pt] {text}' for blocks with known font size
     - '{text}' (no prefix) for blocks without style info (e.g. extracted tables)
     """
-    parts = []
+    buf = io.StringIO()
+    write = buf.write
+    line_count = 0
     char_count = 0
     unique_sizes: set = set()
+    current_page = None
+
+    # One flat loop over (page, block) pairs so the budget check can stop the whole walk
+    page_blocks = itertools.chain.from_iterable(
+        zip(itertools.repeat(page), page.get("blocks", []))
+        for page in idm.get("pages", [])
+    )
 
-    for page in idm.get("pages", []):
-        page_num = page.get("page_number", "?")
-        page_parts = []
-
-        for block in page.get("blocks", []):
-            text = block.get("text", "").strip()
-            if not text:
-                continue
-
-            style = block.get("style")
-            reported_size = style.get("font_size_pt") if style else None
-
-            # Derive font size from bounding-box geometry as a fallback.
-            # Design-heavy PDFs (InDesign exports) often scale text frames after
-            # embedding, so PyMuPDF reports the base font size (e.g. 10pt) rather
-            # than the rendered size (e.g. 40pt). Bbox height ÷ line count ÷ 1.2
-            # (typical leading factor) gives the approximate rendered font size.
-            bbox = block.get("bbox") or {}
-            lines = block.get("lines") or []
-            num_lines = max(len(lines), 1)
-            bbox_h = (bbox.get("y1", 0) - bbox.get("y0", 0))
-            bbox_size = round(bbox_h / num_lines / 1.2, 1) if bbox_h > 4 else None
-
-            # Use the larger of the two estimates. For correct PDFs they agree;
-            # for transformed PDFs the bbox estimate reveals the true rendered size.
-            size = max(reported_size or 0, bbox_size or 0) or None
-
-            if size:
-                unique_sizes.add(round(size, 1))
-                page_parts.append(f"[{size}pt] {text}")
-            else:
-                page_parts.append(text)
-
-            char_count += len(text)
-            if char_count >= MAX_TEXT_CHARS:
-                page_parts.append("[...document truncated for analysis...]")
-                break
-
-        if page_parts:
-            parts.append(f"--- PAGE {page_num} ---")
-            parts.extend(page_parts)
+    for page, block in page_blocks:
+        text = block.get("text", "").strip()
+        if not text:
+            continue
+
+        # Page marker is written lazily so pages without text produce no output
+        if page is not current_page:
+            current_page = page
+            if line_count:
+                write("\n")
+            write(f"--- PAGE {page.get('page_number', '?')} ---")
+            line_count += 1
+
+        style = block.get("style")
+        reported_size = style.get("font_size_pt") if style else None
+
+        # Derive font size from bounding-box geometry as a fallback.
+        # Design-heavy PDFs (InDesign exports) often scale text frames after
+        # embedding, so PyMuPDF reports the base font size (e.g. 10pt) rather
+        # than the rendered size (e.g. 40pt). Bbox height ÷ line count ÷ 1.2
+        # (typical leading factor) gives the approximate rendered font size.
+        bbox = block.get("bbox") or {}
+        num_lines = max(block.get("line_count") or len(block.get("lines") or ()), 1)
+        bbox_h = (bbox.get("y1", 0) - bbox.get("y0", 0))
+        bbox_size = round(bbox_h / num_lines / 1.2, 1) if bbox_h > 4 else None
+
+        # Use the larger of the two estimates. For correct PDFs they agree;
+        # for transformed PDFs the bbox estimate reveals the true rendered size.
+        size = max(reported_size or 0, bbox_size or 0) or None
+
+        write("\n")
+        if size:
+            unique_sizes.add(round(size, 1))
+            write(f"[{size}pt] {text}")
+        else:
+            write(text)
+        line_count += 1
 
+        char_count += len(text)
         if char_count >= MAX_TEXT_CHARS:
+            write("\n[...document truncated for analysis...]")
+            line_count += 1
             break
 
-    condensed = "\n".join(parts)
+    condensed = buf.getvalue()
     print(
         f"Semantic analyzer: condensed text {len(condensed)} chars, "
-        f"{len(parts)} blocks across pages, "
+        f"{line_count} blocks across pages, "
         f"unique font sizes: {sorted(unique_sizes)}"
     )
     return condensed
 
 
+def _spec_cache_key(condensed_text: str, doc_type_line: str, toc_section: str, file_bytes) -> str:
+    """Hash every input of the Claude call: text, prompt extras, page-image source, model, schema."""
+    h = hashlib.blake2b(digest_size=32)
+    for part in (condensed_text, doc_type_line, toc_section):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    if file_bytes:
+        h.update(file_bytes)
+    return f"{h.hexdigest()}:{CLAUDE_MODEL}:{_TOOL_VERSION}"
+
+
+def _spec_cache_get(key: str):
+    spec = _SPEC_CACHE.get(key)
+    if spec is None:
+        return None
+    _SPEC_CACHE.move_to_end(key)
+    return copy.deepcopy(spec)
+
+
+def _spec_cache_put(key: str, spec: dict) -> None:
+    _SPEC_CACHE[key] = copy.deepcopy(spec)
+    _SPEC_CACHE.move_to_end(key)
+    if len(_SPEC_CACHE) > _SPEC_CACHE_MAX:
+        _SPEC_CACHE.popitem(last=False)
+
+
+def _extract_structure(response):
+    """Return the document_structure dict from a Claude response, or None."""
+    # One pass: return the tool use result as soon as it is seen, remembering text
+    # blocks so the JSON fallback only runs when there is no tool call at all
+    text_blocks = []
+    for block in response.content:
+        block_type = block.type
+        if block_type == "tool_use":
+            if block.name == "document_structure":
+                return block.input
+        elif block_type == "text":
+            text_blocks.append(block.text)
+
+    # Fallback: try to parse text response as JSON
+    for text in text_blocks:
+        try:
+            data = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            continue
+        if "sections" in data:
+            return data
+    return None
+
+
 async def analyze_semantic(
     idm: dict,
     client,
@@ -405,6 +490,16 @@ async def analyze_semantic(
         else:
             toc_section = ""
 
+        # Identical inputs (re-index / preview of the same document) reuse the last result
+        cache_key = _spec_cache_key(
+            condensed_text, doc_type_line, toc_section,
+            file_bytes if source_format == "pdf" else None,
+        )
+        cached = _spec_cache_get(cache_key)
+        if cached is not None:
+            print("Semantic analyzer: cache hit, skipping Claude call")
+            return cached
+
         # For PDF files, render pages as images so Claude can see decorative headings
         # that are not captured in the text extraction (common in InDesign-exported PDFs).
         page_images = []
@@ -449,31 +544,17 @@ async def analyze_semantic(
             user_content = intro + f"DOCUMENT TEXT:\n{condensed_text}"
 
         response = await client.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=MAX_TOKENS,
-            system=_SYSTEM_PROMPT,
-            tools=[_STRUCTURE_TOOL],
-            tool_choice={"type": "tool", "name": "document_structure"},
+            **_BASE_KWARGS,
             messages=[{"role": "user", "content": user_content}],
         )
 
-        # Extract tool use result
-        for block in response.content:
-            if block.type == "tool_use" and block.name == "document_structure":
-                return block.input
+        spec = _extract_structure(response)
+        if spec is None:
+            print("Semantic analyzer: could not extract structured output from Claude response")
+            raise ValueError("Claude did not return a valid document_structure tool call")
 
-        # Fallback: try to parse text response as JSON
-        for block in response.content:
-            if hasattr(block, "text"):
-                try:
-                    data = json.loads(block.text)
-                    if "sections" in data:
-                        return data
-                except json.JSONDecodeError:
-                    pass
-
-        print("Semantic analyzer: could not extract structured output from Claude response")
-        raise ValueError("Claude did not return a valid document_structure tool call")
+        _spec_cache_put(cache_key, spec)
+        return spec
 
     except Exception as e:
         print(f"Semantic analysis failed: {e}")
@@ -9,19 +9,77 @@ Primary method: aggregate span-level style metadata from the IDM.
 Secondary method: Claude Vision on rendered page images (PDF/image formats),
 used to confirm and fill in tokens not available from metadata.
 
-Note: Page-to-PNG rendering uses PyMuPDF directly (no poppler/pdf2image dependency).
+Note: Page-to-JPEG rendering uses PyMuPDF directly (no poppler/pdf2image dependency).
 """
 
-import base64
-import json
-from collections import Counter, defaultdict
+import asyncio
+import copy
+import hashlib
+import heapq
+import io
+import itertools
+import multiprocessing
+import operator
+import os
+import tempfile
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional
 
+import orjson
+
+# SIMD base64 when available (same API as the stdlib module, several times faster on image payloads)
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+
 
 CLAUDE_MODEL = "claude-sonnet-4-6"
-MAX_TOKENS = 3000
+MAX_TOKENS = 1500          # per document — tool-use output carries no prose or fences
 _VISION_PAGES = 2          # number of pages to render for Claude Vision
-_RENDER_SCALE = 1.5        # 108 DPI equivalent — good quality for vision analysis
+_RENDER_SCALE = 1.5        # 108 DPI equivalent — upper bound on render zoom
+# Vision payload budget: every image sent is at most this many pixels on its long edge,
+# JPEG-encoded — image tokens and upload time scale with pixels, not with PNG fidelity
+_MAX_LONG_EDGE_PX = 1024
+_JPEG_QUALITY = 75
+# PyMuPDF holds the GIL while rendering, so neither a thread nor a thread per page helps;
+# each page renders as its own task in a persistent worker process pool, created on first use
+_RENDER_MAX_WORKERS = 4
+_render_pool: Optional[ProcessPoolExecutor] = None
+
+# Colours left out of the palette census (defaults, not brand colours). Stage A emits
+# color_hex already upper-case (see models.BlockStyle), so membership is a direct lookup.
+_CENSUS_EXCLUDED_COLORS = frozenset({"#000000", "#FFFFFF", "#000"})
+
+# Stage A emits every block with both keys and every style with all BlockStyle fields
+# (models.Block / models.BlockStyle), so the aggregation loop reads them with C-level getters
+_BLOCK_STYLE_TEXT = operator.itemgetter("style", "text")
+_STYLE_TOKEN_FIELDS = operator.itemgetter("font_name", "font_size_pt", "font_weight", "color_hex")
+# Sort key for (token, char_count) counter items. max()/heapq.nlargest() on it pick the same
+# items, ties included, as Counter.most_common(), without its per-call wrapper
+_CHAR_COUNT = operator.itemgetter(1)
+
+# Upper bound on in-flight Claude Vision requests across all concurrent pipeline runs,
+# so batch ingestion queues here instead of tripping Anthropic rate limits (429 retries)
+_VISION_MAX_CONCURRENCY = int(os.environ.get("VISION_MAX_CONCURRENCY", "5"))
+_vision_semaphore = asyncio.Semaphore(_VISION_MAX_CONCURRENCY)
+
+# Formats with pages Claude Vision can look at
+_VISION_FORMATS = frozenset({"pdf", "image", "jpg", "jpeg", "png"})
+# analyze_visual_style_batch packs at most this much base64 image data into one request,
+# well under the API's per-request payload limit (each page is already capped at _MAX_LONG_EDGE_PX)
+_VISION_BATCH_MAX_B64_BYTES = 16 * 1024 * 1024
+
+# Confidence gate for skipping Claude Vision: every role below must be dominated by one
+# style key (share of the role's chars) and the census must fill this many palette slots
+_VISION_SKIP_ROLES = ("h1", "h2", "h3", "body", "caption")
+_VISION_SKIP_MIN_COVERAGE = 0.7
+_VISION_SKIP_MIN_COLORS = 3
+# Render only the first page when it already carries the top style key of at least this
+# many _VISION_SKIP_ROLES — a second page would mostly repeat the same typography
+_FIRST_PAGE_MIN_ROLES = 4
 
 
 # ---------------------------------------------------------------------------
@@ -43,42 +101,54 @@ def _classify_role(size_pt: Optional[float], weight: Optional[str]) -> str:
     return "caption"
 
 
+def _accumulate_style_chars(blocks, style_chars: dict) -> None:
+    """Add each block's char count to style_chars[(font_name, size_pt, weight, color_hex)]."""
+    style_chars_get = style_chars.get
+    # Only blocks with both a style and non-empty text contribute
+    for style, text in map(_BLOCK_STYLE_TEXT, blocks):
+        if not (style and text):
+            continue
+        font_name, size_pt, weight, color_hex = _STYLE_TOKEN_FIELDS(style)
+        key = (font_name or "unknown", size_pt, weight, color_hex or "#000000")
+        style_chars[key] = style_chars_get(key, 0) + len(text)
+
+
 def _extract_tokens_from_idm(idm: dict) -> dict:
     """
     Aggregate font and color data from IDM span styles.
     Returns a dict with:
       - typography_candidates: {role: Counter({(font_name, size_pt, weight, color_hex): char_count})}
       - color_census: Counter({color_hex: char_count})
+      - first_page_keys: frozenset of the style keys with text on the first page
     """
+    # One pass sums char counts per distinct (font_name, size_pt, weight, color_hex);
+    # a document has a few dozen of those, so roles and the census are derived per key.
+    # The first page is summed on its own, so its keys can be snapshotted on the way
+    style_chars: dict = {}
+    pages = idm.get("pages", ())
+    for page in itertools.islice(pages, 1):
+        _accumulate_style_chars(page.get("blocks", ()), style_chars)
+    first_page_keys = frozenset(style_chars)
+    _accumulate_style_chars(
+        itertools.chain.from_iterable(page.get("blocks", ()) for page in itertools.islice(pages, 1, None)),
+        style_chars,
+    )
+
     # role → (font_name, size_pt, weight, color_hex) → char_count
     role_counters: dict = defaultdict(Counter)
     color_census: Counter = Counter()
+    for key, char_count in style_chars.items():
+        _, size_pt, weight, color_hex = key
+        role_counters[_classify_role(size_pt, weight)][key] += char_count
 
-    for page in idm.get("pages", []):
-        for block in page.get("blocks", []):
-            style = block.get("style")
-            if not style:
-                continue
-            text = block.get("text", "")
-            if not text:
-                continue
-
-            size_pt = style.get("font_size_pt")
-            weight = style.get("font_weight", "normal")
-            font_name = style.get("font_name") or "unknown"
-            color_hex = style.get("color_hex") or "#000000"
-
-            role = _classify_role(size_pt, weight)
-            key = (font_name, size_pt, weight, color_hex)
-            role_counters[role][key] += len(text)
-
-            # Color census (exclude pure black as it's the default)
-            if color_hex and color_hex.upper() not in ("#000000", "#FFFFFF", "#000"):
-                color_census[color_hex] += len(text)
+        # Color census (exclude pure black as it's the default)
+        if color_hex not in _CENSUS_EXCLUDED_COLORS:
+            color_census[color_hex] += char_count
 
     return {
         "role_counters": dict(role_counters),
         "color_census": color_census,
+        "first_page_keys": first_page_keys,
     }
 
 
@@ -88,7 +158,7 @@ def _build_typography_from_counters(role_counters: dict) -> dict:
     for role, counter in role_counters.items():
         if not counter:
             continue
-        best_key = counter.most_common(1)[0][0]
+        best_key, _ = max(counter.items(), key=_CHAR_COUNT)
         font_name, size_pt, weight, color_hex = best_key
         typography[role] = {
             "font_family": font_name if font_name != "unknown" else None,
@@ -100,9 +170,56 @@ def _build_typography_from_counters(role_counters: dict) -> dict:
     return typography
 
 
+def _role_coverage(role_counters: dict) -> dict:
+    """Share of each role's chars carried by its most-used token: {role: 0.0–1.0}."""
+    coverage = {}
+    for role, counter in role_counters.items():
+        total = sum(counter.values())
+        if total:
+            coverage[role] = max(counter.values()) / total
+    return coverage
+
+
+def _vision_needed(role_counters: dict, color_census: Counter) -> bool:
+    """
+    Decide whether Claude Vision can add anything over the algorithmic tokens.
+    Returns False when every role in _VISION_SKIP_ROLES has coverage above
+    _VISION_SKIP_MIN_COVERAGE and the census yields at least _VISION_SKIP_MIN_COLORS colours.
+    Logs the decision so skipped Vision passes are auditable per upload.
+    """
+    coverage = _role_coverage(role_counters)
+    weak_roles = [r for r in _VISION_SKIP_ROLES if coverage.get(r, 0.0) <= _VISION_SKIP_MIN_COVERAGE]
+    n_colors = min(len(color_census), _VISION_SKIP_MIN_COLORS)
+    summary = ", ".join(f"{r}={coverage.get(r, 0.0):.2f}" for r in _VISION_SKIP_ROLES)
+
+    if weak_roles or n_colors < _VISION_SKIP_MIN_COLORS:
+        print(f"Visual style analyzer: Vision needed (coverage {summary}; palette colors={n_colors})")
+        return True
+    print(f"Visual style analyzer: skipping Claude Vision — metadata tokens sufficient "
+          f"(coverage {summary}; palette colors={n_colors})")
+    return False
+
+
+def _vision_page_count(extracted: dict) -> int:
+    """
+    Number of PDF pages to render for Claude Vision: 1 when the first page already carries
+    the top style key of at least _FIRST_PAGE_MIN_ROLES roles, else _VISION_PAGES.
+    """
+    role_counters = extracted["role_counters"]
+    first_page_keys = extracted["first_page_keys"]
+    covered = [
+        role for role in _VISION_SKIP_ROLES
+        if role_counters.get(role) and max(role_counters[role].items(), key=_CHAR_COUNT)[0] in first_page_keys
+    ]
+    if len(covered) >= _FIRST_PAGE_MIN_ROLES:
+        print(f"Visual style analyzer: page 1 carries the top style of {', '.join(covered)}; rendering 1 page")
+        return 1
+    return _VISION_PAGES
+
+
 def _build_palette_from_census(color_census: Counter) -> dict:
     """Map the top census colors to semantic palette roles."""
-    top_colors = [c for c, _ in color_census.most_common(6)]
+    top_colors = [c for c, _ in heapq.nlargest(6, color_census.items(), key=_CHAR_COUNT)]
     palette = {}
     roles = ["primary", "secondary", "accent", "highlight", "muted", "extra"]
     for i, color in enumerate(top_colors):
@@ -116,69 +233,284 @@ def _build_palette_from_census(color_census: Counter) -> dict:
 # Claude Vision path
 # ---------------------------------------------------------------------------
 
-def _render_pages_to_base64(file_bytes: bytes, n_pages: int = _VISION_PAGES) -> list:
+def _render_page_to_base64(path: str, page_index: int) -> Optional[str]:
     """
-    Render the first n_pages of a PDF to base64-encoded PNGs using PyMuPDF.
-    Returns a list of base64 strings (one per page).
+    Render one page of the PDF at path to a base64-encoded JPEG using PyMuPDF,
+    at _RENDER_SCALE or less so the long edge fits _MAX_LONG_EDGE_PX.
+    Returns None when the document has no such page.
+
+    Runs in a render-pool worker, one task per page, and opens its own document:
+    PyMuPDF documents are not shared across workers.
     """
     import fitz
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    images = []
-    mat = fitz.Matrix(_RENDER_SCALE, _RENDER_SCALE)
-    for i, page in enumerate(doc):
-        if i >= n_pages:
-            break
-        pix = page.get_pixmap(matrix=mat)
-        png_bytes = pix.tobytes("png")
-        images.append(base64.b64encode(png_bytes).decode("utf-8"))
-    doc.close()
-    return images
+    doc = fitz.open(path, filetype="pdf")
+    try:
+        if page_index >= doc.page_count:
+            return None
+        page = doc[page_index]
+        rect = page.rect
+        zoom = min(_RENDER_SCALE, _MAX_LONG_EDGE_PX / max(rect.width, rect.height, 1.0))
+        # JPEG carries neither alpha nor CMYK: ask for 3-channel RGB explicitly rather than
+        # relying on get_pixmap's defaults
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+        jpeg_bytes = pix.tobytes("jpeg", jpg_quality=_JPEG_QUALITY)
+        pix = None  # free the raster before encoding
+        return _b64.b64encode(jpeg_bytes).decode("utf-8")
+    finally:
+        doc.close()
+        # MuPDF keeps decoded fonts/images in its global store after the document closes;
+        # empty it so long-running workers don't hold on to every rendered document's cache
+        fitz.TOOLS.store_shrink(100)
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    if _render_pool is None:
+        ctx = multiprocessing.get_context("spawn")  # never fork the threaded server process
+        _render_pool = ProcessPoolExecutor(
+            max_workers=min(_RENDER_MAX_WORKERS, os.cpu_count() or 1), mp_context=ctx,
+        )
+    return _render_pool
+
+
+async def _run_in_render_pool(fn, *args):
+    """
+    Run fn(*args) in the render pool. A worker that dies (MuPDF segfault, OOM kill) breaks
+    the whole executor for good, so a broken pool is discarded and the call retried once
+    on a fresh one instead of failing every later render until the server restarts.
+    """
+    global _render_pool
+    loop = asyncio.get_running_loop()
+    pool = _get_render_pool()
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # Concurrent page renders all see the same broken pool; only the first replaces it
+        if _render_pool is pool:
+            print("Visual style analyzer: render worker died; restarting the render pool")
+            _render_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        return await loop.run_in_executor(_get_render_pool(), fn, *args)
+
+
+def _write_temp_pdf(file_bytes: bytes) -> str:
+    """Write file_bytes to a new temporary .pdf file and return its path; the caller unlinks it."""
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as tmp:
+        tmp.write(file_bytes)
+    return path
+
+
+def _image_to_base64_jpeg(file_bytes: bytes) -> str:
+    """Downscale a raw image file to fit _MAX_LONG_EDGE_PX and re-encode it as base64 JPEG."""
+    from PIL import Image
+    with Image.open(io.BytesIO(file_bytes)) as img:
+        img = img.convert("RGB")  # JPEG has no alpha / palette modes
+        img.thumbnail((_MAX_LONG_EDGE_PX, _MAX_LONG_EDGE_PX), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=_JPEG_QUALITY)
+    return _b64.b64encode(buf.getvalue()).decode("utf-8")
 
 
 _VISION_SYSTEM_PROMPT = """You are a visual design analyst specialising in professional document typography and brand style.
 
-Your task is to examine the provided document page images and return precise visual design tokens as a JSON object.
+Your task is to examine the provided document page images and report precise visual design tokens.
 Focus on: font families, sizes, weights, colors, and structural style patterns.
-Return ONLY the JSON object — no markdown, no prose."""
-
-_VISION_USER_TEMPLATE = """Analyse the visual design of these document pages and return a JSON object with this exact structure:
-
-{{
-  "typography": {{
-    "h1": {{"font_family": "...", "size_pt": N, "weight": "bold|normal", "color_hex": "#RRGGBB"}},
-    "h2": {{"font_family": "...", "size_pt": N, "weight": "bold|normal", "color_hex": "#RRGGBB"}},
-    "h3": {{"font_family": "...", "size_pt": N, "weight": "bold|normal", "color_hex": "#RRGGBB"}},
-    "body": {{"font_family": "...", "size_pt": N, "weight": "normal", "color_hex": "#RRGGBB"}},
-    "caption": {{"font_family": "...", "size_pt": N, "weight": "normal", "color_hex": "#RRGGBB"}},
-    "table_header": {{"font_family": "...", "size_pt": N, "weight": "bold|normal", "color_hex": "#RRGGBB"}}
-  }},
-  "color_palette": {{
-    "primary": "#RRGGBB",
-    "secondary": "#RRGGBB",
-    "accent": "#RRGGBB",
-    "background": "#FFFFFF",
-    "table_header_bg": "#RRGGBB",
-    "table_row_alt_bg": "#RRGGBB"
-  }},
-  "bullet_style": {{"level_1": "•|–|▪|○", "level_2": "–|◦|▸", "indent_pt": N}},
-  "paragraph_rules": {{"first_line_indent_pt": N, "space_between_paragraphs_pt": N}}
-}}
-
-Candidate values extracted algorithmically (confirm or correct these):
-{candidate_json}
-
-Return only the JSON object."""
-
-
-async def _run_claude_vision(file_bytes: bytes, source_format: str, candidate_tokens: dict, client) -> dict:
+Report the tokens only through the tool provided."""
+
+
+def _typography_token_schema(description: str) -> dict:
+    return {
+        "type": "object",
+        "description": description,
+        "properties": {
+            "font_family": {"type": "string"},
+            "size_pt": {"type": "number"},
+            "weight": {"type": "string", "enum": ["bold", "normal"]},
+            "color_hex": {"type": "string", "description": "#RRGGBB"},
+        },
+    }
+
+
+_HEX = {"type": "string", "description": "#RRGGBB"}
+
+# Token object Claude returns per document (shared by the single and batched tools)
+_VISUAL_TOKENS_PROPERTIES = {
+    "typography": {
+        "type": "object",
+        "properties": {
+            "h1": _typography_token_schema("Top-level headings / document title."),
+            "h2": _typography_token_schema("Section headings."),
+            "h3": _typography_token_schema("Sub-section headings."),
+            "body": _typography_token_schema("Running body text."),
+            "caption": _typography_token_schema("Captions, footnotes, small print."),
+            "table_header": _typography_token_schema("Table header cells."),
+        },
+    },
+    "color_palette": {
+        "type": "object",
+        "properties": {
+            "primary": _HEX,
+            "secondary": _HEX,
+            "accent": _HEX,
+            "background": _HEX,
+            "table_header_bg": _HEX,
+            "table_row_alt_bg": _HEX,
+        },
+    },
+    "bullet_style": {
+        "type": "object",
+        "properties": {
+            "level_1": {"type": "string", "description": "e.g. • – ▪ ○"},
+            "level_2": {"type": "string", "description": "e.g. – ◦ ▸"},
+            "indent_pt": {"type": "number"},
+        },
+    },
+    "paragraph_rules": {
+        "type": "object",
+        "properties": {
+            "first_line_indent_pt": {"type": "number"},
+            "space_between_paragraphs_pt": {"type": "number"},
+        },
+    },
+}
+
+_VISION_TOOL = {
+    "name": "return_visual_tokens",
+    "description": "Return the visual design tokens observed in the document pages.",
+    "input_schema": {
+        "type": "object",
+        "properties": _VISUAL_TOKENS_PROPERTIES,
+        "required": ["typography", "color_palette", "bullet_style", "paragraph_rules"],
+    },
+}
+
+_VISION_BATCH_TOOL = {
+    "name": "return_visual_tokens_batch",
+    "description": "Return the visual design tokens observed for each labelled document.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "documents": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index": {"type": "integer", "description": "The document's label index."},
+                        **_VISUAL_TOKENS_PROPERTIES,
+                    },
+                    "required": ["index", "typography", "color_palette", "bullet_style", "paragraph_rules"],
+                },
+            },
+        },
+        "required": ["documents"],
+    },
+}
+
+_VISION_USER_TEMPLATE = (
+    "Analyse the visual design of these document pages and report the tokens with the "
+    "return_visual_tokens tool.\n\n"
+    "Candidate values extracted algorithmically (confirm or correct these):\n{candidate_json}"
+)
+
+_VISION_BATCH_USER_TEMPLATE = (
+    "These pages come from {n_docs} separate documents. Each document starts with a "
+    "\"Document <index>:\" label, followed by its algorithmically extracted candidate values "
+    "(confirm or correct these) and then its page images.\n\n"
+    "Analyse each document's visual design independently and report the tokens with the "
+    "return_visual_tokens_batch tool, one entry per document."
+)
+
+# The single-document prompt is constant around the candidate JSON: resolve the template
+# once here, so each call only serialises the candidate dict and concatenates
+_VISION_PROMPT_PREFIX, _VISION_PROMPT_SUFFIX = _VISION_USER_TEMPLATE.format(candidate_json="\0").split("\0")
+
+
+# Bounded LRU of Vision results keyed on file bytes + candidate tokens (see _vision_cache_key).
+# _VISION_VERSION changes whenever the prompts, tool schemas, or page-image budget are edited.
+_VISION_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+_VISION_CACHE_MAX = 256
+_VISION_VERSION = hashlib.blake2b(
+    f"{_VISION_SYSTEM_PROMPT}\0{_VISION_USER_TEMPLATE}\0{_VISION_BATCH_USER_TEMPLATE}\0"
+    f"{_VISION_PAGES}:{_RENDER_SCALE}:{_MAX_LONG_EDGE_PX}:{_JPEG_QUALITY}".encode("utf-8")
+    + orjson.dumps([_VISION_TOOL, _VISION_BATCH_TOOL], option=orjson.OPT_SORT_KEYS),
+    digest_size=8,
+).hexdigest()
+
+
+def _vision_cache_key(file_bytes: bytes, candidate_tokens: dict, n_pages: int = _VISION_PAGES) -> str:
+    """Hash every input of the Vision call: source file, candidate tokens, pages, model, prompt version."""
+    file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    candidate_hash = hashlib.blake2b(
+        orjson.dumps(candidate_tokens, option=orjson.OPT_SORT_KEYS), digest_size=8,
+    ).hexdigest()
+    return f"{file_hash}:{candidate_hash}:{n_pages}:{CLAUDE_MODEL}:{_VISION_VERSION}"
+
+
+def _vision_cache_get(key: str):
+    tokens = _VISION_CACHE.get(key)
+    if tokens is None:
+        return None
+    _VISION_CACHE.move_to_end(key)
+    return copy.deepcopy(tokens)
+
+
+def _vision_cache_put(key: str, tokens: dict) -> None:
+    _VISION_CACHE[key] = copy.deepcopy(tokens)
+    _VISION_CACHE.move_to_end(key)
+    if len(_VISION_CACHE) > _VISION_CACHE_MAX:
+        _VISION_CACHE.popitem(last=False)
+
+
+async def _vision_page_images(file_bytes: bytes, source_format: str, n_pages: int = _VISION_PAGES) -> list:
+    """Base64 JPEGs to send to Claude Vision: the first n_pages of a PDF, or the image itself."""
+    if source_format == "pdf":
+        # Page tasks open the PDF by path: the upload is written to one temporary file
+        # rather than pickled to every task
+        path = await asyncio.to_thread(_write_temp_pdf, file_bytes)
+        try:
+            pages = await asyncio.gather(*(
+                _run_in_render_pool(_render_page_to_base64, path, i) for i in range(n_pages)
+            ))
+        finally:
+            os.unlink(path)
+        return [img for img in pages if img is not None]
+    # Raw image file (Pillow releases the GIL while resampling)
+    return [await asyncio.to_thread(_image_to_base64_jpeg, file_bytes)]
+
+
+def _image_block(img_b64: str) -> dict:
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": "image/jpeg",
+            "data": img_b64,
+        },
+    }
+
+
+def _tool_input(response, tool_name: str) -> dict:
+    """Return the input of the named tool call in a Vision reply, or {} when there is none."""
+    for block in response.content:
+        if block.type == "tool_use" and block.name == tool_name:
+            return block.input
+    print(f"Claude Vision reply contained no {tool_name} call. Falling back to algorithmic tokens.")
+    return {}
+
+
+async def _run_claude_vision(
+    file_bytes: bytes, source_format: str, candidate_tokens: dict, client, n_pages: int = _VISION_PAGES,
+) -> dict:
     """Call Claude Vision on rendered page images to confirm/fill visual tokens."""
     try:
-        if source_format == "pdf":
-            page_images = _render_pages_to_base64(file_bytes)
-        else:
-            # Raw image file
-            page_images = [base64.b64encode(file_bytes).decode("utf-8")]
+        cache_key = _vision_cache_key(file_bytes, candidate_tokens, n_pages)
+        cached = _vision_cache_get(cache_key)
+        if cached is not None:
+            print("Visual style analyzer: Vision cache hit, skipping render and Claude call")
+            return cached
 
+        page_images = await _vision_page_images(file_bytes, source_format, n_pages)
         if not page_images:
             return {}
 
@@ -186,44 +518,93 @@ async def _run_claude_vision(file_bytes: bytes, source_format: str, candidate_to
         content = [
             {
                 "type": "text",
-                "text": _VISION_USER_TEMPLATE.format(
-                    candidate_json=json.dumps(candidate_tokens, indent=2)
-                ),
+                "text": _VISION_PROMPT_PREFIX
+                        + orjson.dumps(candidate_tokens).decode("utf-8")
+                        + _VISION_PROMPT_SUFFIX,
             }
         ]
-        for img_b64 in page_images:
-            content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": "image/png",
-                    "data": img_b64,
-                },
-            })
+        content.extend(_image_block(img_b64) for img_b64 in page_images)
+
+        async with _vision_semaphore:
+            response = await client.messages.create(
+                model=CLAUDE_MODEL,
+                max_tokens=MAX_TOKENS,
+                system=_VISION_SYSTEM_PROMPT,
+                tools=[_VISION_TOOL],
+                tool_choice={"type": "tool", "name": "return_visual_tokens"},
+                messages=[{"role": "user", "content": content}],
+            )
+
+        vision_tokens = _tool_input(response, "return_visual_tokens")
+        if vision_tokens:
+            _vision_cache_put(cache_key, vision_tokens)
+        return vision_tokens
 
-        response = await client.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=MAX_TOKENS,
-            system=_VISION_SYSTEM_PROMPT,
-            messages=[{"role": "user", "content": content}],
-        )
+    except Exception as e:
+        print(f"Claude Vision call failed: {e}. Falling back to algorithmic tokens.")
+        return {}
+
+
+async def _run_claude_vision_batch(docs: list, client) -> dict:
+    """
+    One Claude Vision call covering several documents.
 
-        text = response.content[0].text if response.content else "{}"
-        # Strip markdown fences
-        text = text.strip()
-        if text.startswith("```"):
-            text = text.split("```")[1]
-            if text.startswith("json"):
-                text = text[4:]
-        text = text.strip()
+    Args:
+        docs: [(index, candidate_tokens, page_images)], index labelling the document in the prompt.
 
-        return json.loads(text)
+    Returns:
+        {index: vision_tokens} for every document the reply covered; {} on failure.
+    """
+    try:
+        candidates_by_index = {}
+        content = [{"type": "text", "text": _VISION_BATCH_USER_TEMPLATE.format(n_docs=len(docs))}]
+        for index, candidate_tokens, page_images in docs:
+            candidates_by_index[index] = candidate_tokens
+            content.append({
+                "type": "text",
+                "text": f"Document {index}:\n"
+                        + orjson.dumps(candidate_tokens).decode("utf-8"),
+            })
+            content.extend(_image_block(img_b64) for img_b64 in page_images)
+
+        async with _vision_semaphore:
+            response = await client.messages.create(
+                model=CLAUDE_MODEL,
+                max_tokens=MAX_TOKENS * len(docs),
+                system=_VISION_SYSTEM_PROMPT,
+                tools=[_VISION_BATCH_TOOL],
+                tool_choice={"type": "tool", "name": "return_visual_tokens_batch"},
+                messages=[{"role": "user", "content": content}],
+            )
+
+        results = {}
+        for entry in _tool_input(response, "return_visual_tokens_batch").get("documents", ()):
+            index = entry.pop("index", None)
+            if index in candidates_by_index and entry:
+                results[index] = entry
+        print(f"Visual style analyzer: batched Vision call returned tokens for {len(results)}/{len(docs)} documents")
+        return results
 
     except Exception as e:
-        print(f"Claude Vision call failed: {e}. Falling back to algorithmic tokens.")
+        print(f"Claude Vision batch call failed: {e}. Falling back to algorithmic tokens.")
         return {}
 
 
+def _pack_vision_batches(docs: list, batch: int) -> list:
+    """Group [(index, candidate_tokens, page_images)] into requests of ≤ batch docs and ≤ the byte budget."""
+    groups, group, group_bytes = [], [], 0
+    for doc in docs:
+        doc_bytes = sum(len(img) for img in doc[2])
+        if group and (len(group) >= batch or group_bytes + doc_bytes > _VISION_BATCH_MAX_B64_BYTES):
+            groups.append(group)
+            group, group_bytes = [], 0
+        group.append(doc)
+        group_bytes += doc_bytes
+    if group:
+        groups.append(group)
+    return groups
+
+
 def _merge_tokens(algorithmic: dict, vision: dict) -> dict:
     """
     Merge algorithmic and vision-derived tokens.
@@ -307,7 +688,7 @@ async def _generate_visual_style_guidance(tokens: dict, client) -> str:
             messages=[{
                 "role": "user",
                 "content": _GUIDANCE_USER_TEMPLATE.format(
-                    tokens_json=json.dumps(tokens, indent=2)
+                    tokens_json=orjson.dumps(tokens, option=orjson.OPT_INDENT_2).decode("utf-8")
                 ),
             }],
         )
@@ -321,6 +702,41 @@ async def _generate_visual_style_guidance(tokens: dict, client) -> str:
 # Entry point
 # ---------------------------------------------------------------------------
 
+def _algorithmic_tokens(idm: dict) -> tuple:
+    """Step 1: tokens from IDM metadata. Returns (extracted, algorithmic_tokens)."""
+    extracted = _extract_tokens_from_idm(idm)
+    algorithmic_tokens = {
+        "typography": _build_typography_from_counters(extracted["role_counters"]),
+        "color_palette": _build_palette_from_census(extracted["color_census"]),
+        "bullet_style": {"level_1": "•", "level_2": "–", "indent_pt": 18.0},
+        "paragraph_rules": {"first_line_indent_pt": 0.0, "space_between_paragraphs_pt": 6.0},
+    }
+    return extracted, algorithmic_tokens
+
+
+async def _finalize_tokens(algorithmic_tokens: dict, vision_tokens: dict, client) -> dict:
+    """Steps 3–4: merge, fill required roles, and attach the natural-language guidance."""
+    final_tokens = _merge_tokens(algorithmic_tokens, vision_tokens)
+
+    # Ensure required roles exist with sentinel values if missing
+    for role in ("h1", "body"):
+        if role not in final_tokens.get("typography", {}):
+            final_tokens.setdefault("typography", {})[role] = {
+                "font_family": None,
+                "size_pt": None,
+                "weight": "bold" if role == "h1" else "normal",
+                "color_hex": "#000000",
+                "inferred": True,
+            }
+
+    # Generate natural-language guidance for the generation prompt
+    print("Visual style analyzer: generating natural-language style guidance")
+    guidance = await _generate_visual_style_guidance(final_tokens, client)
+    final_tokens["visual_style_guidance"] = guidance
+
+    return final_tokens
+
+
 async def analyze_visual_style(file_bytes: bytes, source_format: str, idm: dict, client) -> dict:
     """
     Stage D entry point.
@@ -338,44 +754,95 @@ async def analyze_visual_style(file_bytes: bytes, source_format: str, idm: dict,
     """
     try:
         # Step 1: algorithmic extraction from IDM metadata
-        extracted = _extract_tokens_from_idm(idm)
-        alg_typography = _build_typography_from_counters(extracted["role_counters"])
-        alg_palette = _build_palette_from_census(extracted["color_census"])
-
-        algorithmic_tokens = {
-            "typography": alg_typography,
-            "color_palette": alg_palette,
-            "bullet_style": {"level_1": "•", "level_2": "–", "indent_pt": 18.0},
-            "paragraph_rules": {"first_line_indent_pt": 0.0, "space_between_paragraphs_pt": 6.0},
-        }
+        extracted, algorithmic_tokens = _algorithmic_tokens(idm)
 
-        # Step 2: Claude Vision for PDF and image formats (fills gaps, confirms values)
+        # Step 2: Claude Vision for PDF and image formats (fills gaps, confirms values),
+        # unless the metadata tokens already pass the confidence gate
         vision_tokens = {}
-        if source_format in ("pdf", "image", "jpg", "jpeg", "png"):
+        if source_format in _VISION_FORMATS and _vision_needed(
+            extracted["role_counters"], extracted["color_census"]
+        ):
             print("Visual style analyzer: running Claude Vision pass")
-            vision_tokens = await _run_claude_vision(file_bytes, source_format, algorithmic_tokens, client)
+            n_pages = _vision_page_count(extracted) if source_format == "pdf" else _VISION_PAGES
+            vision_tokens = await _run_claude_vision(
+                file_bytes, source_format, algorithmic_tokens, client, n_pages,
+            )
 
-        # Step 3: merge
-        final_tokens = _merge_tokens(algorithmic_tokens, vision_tokens)
+        # Steps 3–4: merge, then natural-language guidance for the generation prompt
+        return await _finalize_tokens(algorithmic_tokens, vision_tokens, client)
 
-        # Ensure required roles exist with sentinel values if missing
-        for role in ("h1", "body"):
-            if role not in final_tokens.get("typography", {}):
-                final_tokens.setdefault("typography", {})[role] = {
-                    "font_family": None,
-                    "size_pt": None,
-                    "weight": "bold" if role == "h1" else "normal",
-                    "color_hex": "#000000",
-                    "inferred": True,
-                }
+    except Exception as e:
+        print(f"Visual style analysis failed: {e}")
+        raise
+
+
+async def analyze_visual_style_batch(items: list, client, batch: int = 4) -> list:
+    """
+    Stage D over several documents, for bulk ingestion.
 
-        # Step 4: generate natural-language guidance for the generation prompt
-        print("Visual style analyzer: generating natural-language style guidance")
-        guidance = await _generate_visual_style_guidance(final_tokens, client)
-        final_tokens["visual_style_guidance"] = guidance
+    Same result per document as analyze_visual_style(), but documents that still need the
+    Vision pass are packed up to `batch` at a time (and within _VISION_BATCH_MAX_B64_BYTES of
+    page images) into a single Claude request, amortising per-request overhead.
 
-        return final_tokens
+    Args:
+        items:  [(file_bytes, source_format, idm)] — the analyze_visual_style() arguments.
+        client: anthropic.AsyncAnthropic instance.
+        batch:  maximum documents per Vision request.
+
+    Returns:
+        list of visual_style_spec dicts, in the order of `items`.
+    """
+    try:
+        # Step 1: algorithmic extraction, confidence gate, and cache lookup per document
+        algorithmic = []
+        page_counts = []
+        vision_tokens = [{} for _ in items]
+        pending = []
+        for index, (file_bytes, source_format, idm) in enumerate(items):
+            extracted, algorithmic_tokens = _algorithmic_tokens(idm)
+            algorithmic.append(algorithmic_tokens)
+            page_counts.append(_VISION_PAGES)
+            if source_format not in _VISION_FORMATS or not _vision_needed(
+                extracted["role_counters"], extracted["color_census"]
+            ):
+                continue
+            if source_format == "pdf":
+                page_counts[index] = _vision_page_count(extracted)
+            cached = _vision_cache_get(_vision_cache_key(file_bytes, algorithmic_tokens, page_counts[index]))
+            if cached is not None:
+                print(f"Visual style analyzer: Vision cache hit for document {index}")
+                vision_tokens[index] = cached
+            else:
+                pending.append(index)
+
+        # Step 2: render pending documents, then one Vision request per packed group
+        if pending:
+            rendered = await asyncio.gather(
+                *(_vision_page_images(items[i][0], items[i][1], page_counts[i]) for i in pending),
+                return_exceptions=True,
+            )
+            docs = []
+            for index, page_images in zip(pending, rendered):
+                if isinstance(page_images, Exception):
+                    print(f"Visual style analyzer: rendering document {index} failed: {page_images}")
+                elif page_images:
+                    docs.append((index, algorithmic[index], page_images))
+
+            groups = _pack_vision_batches(docs, max(1, batch))
+            print(f"Visual style analyzer: running Claude Vision for {len(docs)} documents "
+                  f"in {len(groups)} request(s)")
+            for results in await asyncio.gather(*(_run_claude_vision_batch(g, client) for g in groups)):
+                for index, tokens in results.items():
+                    vision_tokens[index] = tokens
+                    _vision_cache_put(
+                        _vision_cache_key(items[index][0], algorithmic[index], page_counts[index]), tokens,
+                    )
+
+        # Steps 3–4 per document
+        return list(await asyncio.gather(*(
+            _finalize_tokens(algorithmic[i], vision_tokens[i], client) for i in range(len(items))
+        )))
 
     except Exception as e:
-        print(f"Visual style analysis failed: {e}")
+        print(f"Visual style batch analysis failed: {e}")
         raise